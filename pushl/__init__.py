@@ -1,7 +1,9 @@
 """ Functionality to add push-ish notifications to feed-based sites """
 
 import asyncio
+import concurrent.futures
 import logging
+import os
 import typing
 
 import aiohttp
@@ -19,10 +21,10 @@ class Pushl:
         """ Set up the process worker """
         self.args = args
         self.cache = caching.Cache(args.cache_dir) if args.cache_dir else None
-        self.rel_include = args.rel_include.split(
-            ',') if args.rel_include else None
-        self.rel_exclude = args.rel_exclude.split(
-            ',') if args.rel_exclude else None
+        self.rel_include = frozenset(args.rel_include.split(
+            ',')) if args.rel_include else None
+        self.rel_exclude = frozenset(args.rel_exclude.split(
+            ',')) if args.rel_exclude else None
 
         self._processed_feeds: typing.Set[typing.Tuple[str, bool]] = set()
         self._processed_entries: typing.Set[typing.Tuple[str, bool]] = set()
@@ -33,14 +35,24 @@ class Pushl:
 
         self._processed_wayback: typing.Set[str] = set()
 
+        # webmention target lookups, by URL
+        self.targets: typing.Dict[str, asyncio.Task] = {}
+
         self.session = session
 
+        # Parsing is CPU-bound, so it gets a small pool of its own rather than
+        # competing with everything else in the default executor
+        self.parse_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(8, os.cpu_count() or 1),
+            thread_name_prefix='pushl-parse')
+
     @staticmethod
     async def _run_pending(pending, label: str):
         if pending:
             LOGGER.debug("+++WAIT: %s: %d subtasks",
                          label, len(pending))
-            LOGGER.debug("%s", [name for (name, _) in pending])
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("%s", [name for (name, _) in pending])
             await asyncio.wait([asyncio.create_task(coro) for (_, coro) in pending])
             LOGGER.debug("+++DONE: %s: %d subtasks",
                          label, len(pending))
@@ -72,14 +84,14 @@ class Pushl:
         # RFC5005
         if self.args.archive:
             for rel in ('prev-archive', 'next-archive', 'prev-page', 'next-page'):
-                for link in feed.links[rel]:
+                for link in feed.links.get(rel, ()):
                     LOGGER.debug('%s: %s', rel, link)
                     pending.append(("process feed " + link,
                                     self.process_feed(link, send_mentions)))
 
         # WebSub
         if updated and not feed.is_archive:
-            for hub in feed.links['hub']:
+            for hub in feed.links.get('hub', ()):
                 LOGGER.debug("Found hub %s", hub)
                 pending.append(("update websub " + hub,
                                 self.send_websub(feed.canonical, hub)))
@@ -62,6 +62,11 @@ def parse_args(*args):
     parser.add_argument('--max-time', '-m', dest='max_time', type=float,
                         help="Maximum time (in seconds) to spend on this", default=1800)
 
+    parser.add_argument('--max-retry-after', dest='max_retry_after', type=float,
+                        help="Maximum time (in seconds) to wait when an endpoint asks us"
+                        + " to retry later",
+                        default=60.0)
+
     parser.add_argument('--user-agent', dest='user_agent', type=str,
                         help="User-agent string to send",
                         default=DEFAULT_USERAGENT)
@@ -130,11 +135,14 @@ def main():
 
 
 async def _run(args: argparse.Namespace):
+    # A single session (and connection pool) is shared by every request
     connector = aiohttp.TCPConnector(
         limit=args.max_connections,
         limit_per_host=args.max_per_host,
+        ttl_dns_cache=300,
         enable_cleanup_closed=True,
-        force_close=not args.keepalive
+        force_close=not args.keepalive,
+        keepalive_timeout=75 if args.keepalive else None
     )
 
     # Time spent waiting for a connection pool entry to free up counts against
@@ -147,7 +155,8 @@ async def _run(args: argparse.Namespace):
         sock_read=args.timeout)
 
     async with aiohttp.ClientSession(timeout=timeout,
-                                     connector=connector) as session:
+                                     connector=connector,
+                                     headers={'User-Agent': args.user_agent}) as session:
         worker = Pushl(session, args)
 
         pending: typing.List[typing.Coroutine] = []
@@ -169,6 +178,8 @@ async def _run(args: argparse.Namespace):
             else:
                 LOGGER.info("Completed all tasks")
 
+        worker.parse_pool.shutdown(wait=False, cancel_futures=True)
+
 
 if __name__ == "__main__":
     main()
@@ -4,6 +4,7 @@ import hashlib
 import logging
 import os
 import pickle
+import string
 import sys
 import typing
 
@@ -12,6 +13,18 @@ from slugify import slugify
 
 LOGGER = logging.getLogger(__name__)
 
+# Maps every printable non-alphanumeric ASCII character to a hyphen, for
+# building the human-readable part of a cache filename
+_SLUG_TABLE = str.maketrans(
+    {c: '-' for c in string.printable if not c.isalnum()})
+
+
+def _slug(url: str) -> str:
+    """ Get a short filename-safe hint for a URL """
+    slug = url.encode('ascii', 'ignore').decode(
+        'ascii').translate(_SLUG_TABLE).strip('-')[:24].lower()
+    return slug or slugify(url)[:24]
+
 
 class Cache:
     """ A very simple file-based object cache """
@@ -24,7 +37,7 @@ class Cache:
             return None
 
         md5 = hashlib.md5(url.encode('utf-8'))
-        filename = md5.hexdigest()[:8] + '.' + slugify(url)[:24]
+        filename = md5.hexdigest()[:8] + '.' + _slug(url)
 
         return os.path.join(self.cache_dir, prefix, filename)
 
@@ -69,13 +82,13 @@ class Cache:
 
         with open(filename, 'wb') as file:
             try:
-                pickle.dump(obj, file)
+                pickle.dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL)
             except ValueError:
                 LOGGER.exception("Error pickling %s: filename=%s file=%s",
                                  obj, filename, file)
 
 
-def make_headers(headers: multidict.CIMultiDict) -> typing.Dict[str, str]:
+def make_headers(headers: multidict.CIMultiDictProxy) -> typing.Dict[str, str]:
     """ Make the cache control headers based on a previous request's
     response headers
     """
@@ -85,3 +98,20 @@ def make_headers(headers: multidict.CIMultiDict) -> typing.Dict[str, str]:
     if 'last-modified' in headers:
         out['if-modified-since'] = headers['last-modified']
     return out
+
+
+def get_max_age(headers: multidict.CIMultiDictProxy) -> typing.Optional[int]:
+    """ Get how long a response can be reused without revalidating it, based
+    on its Cache-Control header
+    """
+    max_age = None
+    for directive in headers.get('cache-control', '').lower().split(','):
+        name, _, value = directive.strip().partition('=')
+        if name in ('no-cache', 'no-store'):
+            return None
+        if name == 'max-age':
+            try:
+                max_age = int(value.strip('"'))
+            except ValueError:
+                return None
+    return max_age
@@ -1,19 +1,34 @@
 """ Functions for handling entries """
 
-import hashlib
 import logging
+import sys
 import typing
 import urllib.parse
 
-from bs4 import BeautifulSoup
+import lxml.etree
+import lxml.html
 
 from . import caching, utils
 
 LOGGER = logging.getLogger(__name__)
-SCHEMA_VERSION = 3
+SCHEMA_VERSION = 6
 
 ACCEPT_HEADER = 'text/html, application/xhtml+xml, */*;q=0.1'
 
+FEED_TYPES = frozenset(('text/xml',
+                        'application/rdf+xml',
+                        'application/rss+xml',
+                        'application/atom+xml',
+                        'application/xml'))
+
+# Every candidate article container, found in a single pass
+ARTICLE_XPATH = lxml.etree.XPath(
+    "//*[self::article or contains(concat(' ', normalize-space(@class), ' '), ' h-entry ')"
+    " or contains(concat(' ', normalize-space(@class), ' '), ' entry ')]")
+
+# The only <link> elements that can declare a feed, hub, or canonical URL
+LINK_XPATH = lxml.etree.XPath('//link[@rel and @href]')
+
 
 class Entry:
     """ Encapsulates a scanned entry """
@@ -21,115 +36,129 @@ class Entry:
 
     def __init__(self, request: utils.RequestResult):
         """ Build an Entry from a completed request """
-        text = request.text
-        self.digest = hashlib.md5(text.encode('utf-8')).digest()
-
         self.url = str(request.url)  # the resolved URL
         self.status = request.status
         self.caching = caching.make_headers(request.headers)
 
         if 200 <= self.status < 300:
             # We have new content, so parse out the relevant stuff
-            soup = BeautifulSoup(text, 'html.parser')
-            articles = self._get_articles(soup)
-
-            self._targets: typing.List[typing.Dict] = []
-            for node in articles:
-                self._targets += [link.attrs
-                                  for link in node.find_all('a', href=True)]
-
-            self.feeds = [urllib.parse.urljoin(self.url, link.attrs['href'])
-                          for link
-                          in soup.find_all('link',
-                                           rel="alternate",
-                                           href=True,
-                                           type={'text/xml',
-                                                 'application/rdf+xml',
-                                                 'application/rss+xml',
-                                                 'application/atom+xml',
-                                                 'application/xml'}
-                                           )]
-            self.feeds += [urllib.parse.urljoin(self.url, link.attrs['href'])
-                           for link
-                           in soup.find_all('link', rel="hub")]
-
-            self.hubs = [link.attrs['href']
-                         for link in soup.find_all('link', rel='hub', href=True)]
+            self.digest = utils.digest(request.data)
+            root = utils.parse_html(request)
+
+            # (href, rels) for every outgoing link; the strings are interned so
+            # that repeats are shared in memory and only pickled once
+            self._targets: typing.List[typing.Tuple[str, typing.Tuple[str, ...]]] = []
+            for node in self._get_articles(root):
+                self._targets.extend((sys.intern(link.attrib['href']),
+                                      tuple(sys.intern(rel)
+                                            for rel in link.attrib.get('rel', '').split()))
+                                     for link in node.iterfind('.//a[@href]'))
+
+            self.feeds: typing.List[str] = []
+            self.hubs: typing.List[str] = []
+            canonical = None
+
+            # Collect feeds, hubs, and the canonical URL in a single pass,
+            # resolving everything against the URL we actually retrieved
+            for link in LINK_XPATH(root):
+                rels = link.attrib['rel'].split()
+                href = urllib.parse.urljoin(self.url, link.attrib['href'])
+                if 'alternate' in rels and link.attrib.get('type') in FEED_TYPES:
+                    self.feeds.append(href)
+                if 'hub' in rels:
+                    self.hubs.append(href)
+                if 'canonical' in rels and not canonical:
+                    canonical = href
+
             if 'hub' in request.links:
-                self.hubs.append(request.links['hub']['url'])
+                self.hubs.append(str(request.links['hub']['url']))
 
             # Use the canonical URL if available
-            for link in soup.find_all('link', rel='canonical', href=True):
-                self.url = urllib.parse.urljoin(self.url, link.attrs['href'])
+            if canonical:
+                self.url = canonical
 
         else:
+            # Nothing to parse (e.g. the entry is gone); the status alone is
+            # enough to detect a change
+            self.digest = b''
             self._targets = []
             self.feeds = []
             self.hubs = []
 
+        self._origin = utils.get_domain(self.url)
         self.schema = SCHEMA_VERSION
 
     @staticmethod
-    def _get_articles(soup: BeautifulSoup) -> typing.List[BeautifulSoup]:
-        return (soup.find_all(class_="h-entry")
-                or soup.find_all("article")
-                or soup.find_all(class_="entry")
-                or [soup])
+    def _get_articles(root: lxml.html.HtmlElement) -> typing.List[lxml.html.HtmlElement]:
+        # in descending order of priority
+        h_entries: typing.List[lxml.html.HtmlElement] = []
+        articles: typing.List[lxml.html.HtmlElement] = []
+        entries: typing.List[lxml.html.HtmlElement] = []
+
+        for node in ARTICLE_XPATH(root):
+            classes = node.get('class', '').split()
+            if 'h-entry' in classes:
+                h_entries.append(node)
+            if node.tag == 'article':
+                articles.append(node)
+            if 'entry' in classes:
+                entries.append(node)
+
+        return h_entries or articles or entries or [root]
 
     @staticmethod
-    def _check_rel(attrs: typing.Dict,
-                   rel_include: typing.Optional[typing.List[str]],
-                   rel_exclude: typing.Optional[typing.List[str]]) -> bool:
+    def _check_rel(rels: typing.Sequence[typing.Optional[str]],
+                   rel_include: typing.Optional[typing.AbstractSet[typing.Optional[str]]],
+                   rel_exclude: typing.Optional[typing.AbstractSet[typing.Optional[str]]]) -> bool:
         """ Check a link's relations against the include or exclude.
 
         First, this will reject based on exclude.
 
         Next, if there is a include, there must be at least one rel that matches.
         To explicitly allow links without a rel you can add None to the include
-        (e.g. ['in-reply-to',None])
+        (e.g. {'in-reply-to',None})
         """
 
-        rels = attrs.get('rel', [None])
+        rels = rels or (None,)
 
-        if rel_exclude:
-            # Never return True for a link whose rel appears in the exclusion list
-            for rel in rels:
-                if rel in rel_exclude:
-                    return False
+        # Never return True for a link whose rel appears in the exclusion list
+        if rel_exclude and not rel_exclude.isdisjoint(rels):
+            return False
 
+        # If there is a inclusion list for rels, only return true for a rel that
+        # appears in it
         if rel_include:
-            # If there is a inclusion list for rels, only return true for a rel that
-            # appears in it
-            for rel in rels:
-                if rel in rel_include:
-                    return True
-            # If there is a include and we don't match, then reject
-            return False
+            return not rel_include.isdisjoint(rels)
 
         return True
 
     def _domain_differs(self, href: str) -> bool:
         """ Check that a link is not on the same domain as the source URL """
         target = utils.get_domain(href)
-        if not target:
-            return False
-
-        origin = utils.get_domain(self.url)
-        return target != origin
+        return bool(target) and target != self._origin
 
     def get_targets(self, config) -> typing.Set[typing.Tuple[str, str]]:
         """ Given an Entry object, return all of the outgoing links, as a tuple
         of (resolved_url, original_href). """
 
-        hrefs = [attrs['href']
-                 for attrs in self._targets
-                 if 'href' in attrs and self._check_rel(attrs,
-                                                        config.rel_include,
-                                                        config.rel_exclude)]
+        # Pages tend to link to the same place more than once, so only parse
+        # and resolve each distinct href a single time
+        resolved: typing.Dict[str, typing.Optional[str]] = {}
+
+        targets: typing.Set[typing.Tuple[str, str]] = set()
+        for href, rels in self._targets:
+            if not self._check_rel(rels, config.rel_include, config.rel_exclude):
+                continue
+
+            if href not in resolved:
+                resolved[href] = (urllib.parse.urljoin(self.url, href)
+                                  if config.args.self_pings or self._domain_differs(href)
+                                  else None)
+            target = resolved[href]
+            if target:
+                targets.add((target, href))
 
-        return {(urllib.parse.urljoin(self.url, href), href)
-                for href in hrefs
-                if config.args.self_pings or self._domain_differs(href)}
+        return targets
 
 
 async def get_entry(config,
@@ -174,7 +203,8 @@ async def get_entry(config,
         LOGGER.debug("%s: entry unchanged", url)
         return previous, previous, False
 
-    current = Entry(request)
+    # Hashing and parsing both release the GIL, so do them off the event loop
+    current = await utils.run_parse(config, Entry, request)
 
     # Content updated
     if config.cache:
@@ -1,66 +1,148 @@
 """ Functionality for handling feeds """
 
-import collections
-import hashlib
 import itertools
 import logging
+import sys
 import typing
 import urllib.parse
 
 import feedparser
-import mf2py
+import lxml.etree
 
 from . import caching, utils
 
 LOGGER = logging.getLogger(__name__)
-SCHEMA_VERSION = 5
+SCHEMA_VERSION = 7
 
 ACCEPT_HEADER = \
     'application/atom+xml, application/rss+xml, application/rdf+xml;q=0.9,'\
     'application/xml;q=0.8, text/xml;q=0.8, text/html;q=0.5,'\
     '*/*;q=0.1'
 
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+HISTORY_URI = 'http://purl.org/syndication/history/1.0'
+HISTORY_NS = '{' + HISTORY_URI + '}'
+RDF_NS = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+RSS1_NS = '{http://purl.org/rss/1.0/}'
+
+# Root elements of the feed formats we can read without feedparser
+XML_FEED_ROOTS = (ATOM_NS + 'feed', 'rss', RDF_NS + 'RDF')
+
+# Link types that feedparser considers to be an entry's main link
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+
+
+# A (base URL, href) pair from a feed document, either of which may be missing
+_Href = typing.Tuple[typing.Optional[str], typing.Optional[str]]
+
+
+def _text_href(node: typing.Optional[lxml.etree._Element]) -> _Href:
+    """ Get the URL held in an element's text, along with its base URL """
+    if node is None:
+        return None, None
+    return node.base, node.text
+
+
+def _is_alternate(link: lxml.etree._Element) -> bool:
+    """ Check whether an Atom link is one that feedparser considers to be an
+    entry's main link """
+    return (link.get('rel', 'alternate') == 'alternate'
+            and link.get('type', 'text/html') in HTML_TYPES)
+
+
+def _resolve_link(base: str, href: str) -> str:
+    """ Resolve an entry link against the feed URL, without its fragment """
+    if href.startswith(('http://', 'https://')):
+        # Already absolute, which is the usual case, so skip URL parsing
+        return href.partition('#')[0]
+    return urllib.parse.urldefrag(urllib.parse.urljoin(base, href)).url
+
 
 class Feed:
     """ Encapsulates stuff on feeds """
     # pylint:disable=too-many-instance-attributes,too-few-public-methods
 
-    def __init__(self, request: utils.RequestResult):
-        """ Given a request object and retrieved text, parse out the feed """
-        text = request.text
-        self.digest = hashlib.md5(text.encode('utf-8')).digest()
+    __slots__ = ('digest', 'url', 'caching', 'entry_links', 'links',
+                 'is_archive', '_canonical', 'status', 'schema')
+
+    def __init__(self, request: utils.RequestResult, previous: typing.Optional['Feed'] = None):
+        """ Given a request object and retrieved text, parse out the feed.
+
+        If the previous version of the feed has the same content, its parse
+        results are reused. """
+        self.digest = utils.digest(request.data)
 
         self.url = str(request.url)
         self.caching = caching.make_headers(request.headers)
 
-        self.is_archive = None
+        self.entry_links: typing.Set[str]
+        self.links: typing.Dict[str, typing.Set[str]]
+        self.is_archive: typing.Optional[bool]
+
+        if previous and previous.digest == self.digest and previous.url == self.url:
+            # The server didn't give us a 304, but the content is unchanged
+            LOGGER.debug("%s: content unchanged, reusing previous parse", self.url)
+            self.entry_links, self.links = previous.entry_links, previous.links
+            self.is_archive = previous.is_archive
+            self._canonical = previous.canonical
+        else:
+            self._parse(request)
 
-        feed = feedparser.parse(text)
-        self.entry_links, self.links = self._consume_feed(feed)
+        self.status = request.status
+        self.schema = SCHEMA_VERSION
 
-        if 'bozo_exception' in feed:
-            LOGGER.warning("Feed %s: got error '%s' on line %d", self.url,
-                           feed.bozo_exception.getMessage(),
-                           feed.bozo_exception.getLineNumber())
+    def __setstate__(self, state):
+        # Feeds cached before __slots__ was added pickled their __dict__
+        # directly, rather than as a (dict, slots) tuple
+        if isinstance(state, tuple):
+            state = state[1]
+        for key, value in state.items():
+            setattr(self, key, value)
 
-        if not self.entry_links:
-            # feedparser couldn't find any entries, so maybe it's an mf2 document
+    def _parse(self, request: utils.RequestResult):
+        """ Parse out the entries and links from the feed content """
+        self.is_archive = None
+
+        root = self._parse_xml(request.data, self.url)
+        if root is not None and self._is_plain_feed(root):
+            # Plain Atom and RSS feeds are by far the most common, and only
+            # need a couple of queries to get what we need
+            self.entry_links, self.links = self._consume_xml(root)
+        else:
+            # feedparser does its own encoding detection on the raw bytes. We
+            # only look at links, so don't bother cleaning up entry content.
+            feed = feedparser.parse(request.data,
+                                    resolve_relative_uris=False,
+                                    sanitize_html=False)
+            self.entry_links, self.links = self._consume_feed(feed)
+
+            if 'bozo_exception' in feed:
+                LOGGER.warning("Feed %s: got error '%s' on line %d", self.url,
+                               feed.bozo_exception.getMessage(),
+                               feed.bozo_exception.getLineNumber())
+
+            # feedparser exposes the RFC5005 markers under whatever prefix the
+            # feed bound the history namespace to
+            ns_prefix = next((prefix
+                              for prefix, uri in getattr(feed, 'namespaces', {}).items()
+                              if uri == HISTORY_URI), None)
+            if ns_prefix:
+                if ns_prefix + '_archive' in feed.feed:
+                    self.is_archive = True
+                elif ns_prefix + '_current' in feed.feed:
+                    self.is_archive = False
+
+        # mf2py only finds entries marked up as h-entry (or the older hentry),
+        # so don't bother building a whole parse tree for anything else
+        if not self.entry_links and 'entry' in request.text:
+            # we couldn't find any entries, so maybe it's an mf2 document
             LOGGER.debug("%s: Found no entries, retrying as mf2", self.url)
-            self._consume_mf2(mf2py.parse(text).get('items', []), self.entry_links)
 
-        LOGGER.debug("%s: Found %d entries", self.url, len(self.entry_links))
+            # mf2py pulls in requests, so only load it if it's actually needed
+            import mf2py  # pylint:disable=import-outside-toplevel
+            self._consume_mf2(mf2py.parse(request.text).get('items', []), self.entry_links)
 
-        try:
-            for ns_prefix, url in feed.namespaces.items():
-                if url == 'http://purl.org/syndication/history/1.0':
-                    if ns_prefix + '_archive' in feed.feed:
-                        self.is_archive = True
-                        break
-                    if ns_prefix + '_current' in feed.feed:
-                        self.is_archive = False
-                        break
-        except AttributeError:
-            pass
+        LOGGER.debug("%s: Found %d entries", self.url, len(self.entry_links))
 
         if self.is_archive is None:
             # We haven't found an archive namespace prefix, so see if there's
@@ -68,8 +150,108 @@ class Feed:
             self.is_archive = ('current' in self.links and
                                self.links.get('self') != self.links['current'])
 
-        self.status = request.status
-        self.schema = SCHEMA_VERSION
+        self._canonical = next(itertools.chain(self.links.get('canonical', ()),
+                                               self.links.get('self', ())),
+                               self.url)
+
+    @staticmethod
+    def _parse_xml(data: bytes, url: str) -> typing.Optional[lxml.etree._Element]:
+        """ Parse the document as XML, if it is XML; every element's .base is
+        then resolved against the feed URL and any xml:base attributes """
+        try:
+            return lxml.etree.fromstring(data, lxml.etree.XMLParser(resolve_entities=False,
+                                                                    no_network=True),
+                                         base_url=url)
+        except lxml.etree.XMLSyntaxError:
+            return None
+
+    @staticmethod
+    def _is_plain_feed(root: lxml.etree._Element) -> bool:
+        """ Check whether a parsed document is a feed we can read directly """
+        if root.tag == RDF_NS + 'RDF':
+            # Other RDF-based formats (such as RSS 0.90) are left to feedparser
+            return root.find(RSS1_NS + 'channel') is not None
+        return root.tag in XML_FEED_ROOTS
+
+    def _consume_xml(self, root: lxml.etree._Element) -> typing.Tuple[
+            typing.Set[str], typing.Dict[str, typing.Set[str]]]:
+        """ Given a parsed Atom, RSS, or RSS 1.0 document, return the links to
+        its entries and the rel-links for the feed """
+        feed_links: typing.Dict[str, typing.Set[str]] = {}
+
+        if root.tag == 'rss':
+            head = root.find('channel')
+            if head is None:
+                return set(), feed_links
+            hrefs = self._rss_entry_links(head)
+            alternate = head.find('link')
+        elif root.tag == RDF_NS + 'RDF':
+            # RSS 1.0 items are siblings of the channel, not children
+            hrefs = (_text_href(item.find(RSS1_NS + 'link'))
+                     for item in root.iterfind(RSS1_NS + 'item'))
+            head = root.find(RSS1_NS + 'channel')
+            alternate = head.find(RSS1_NS + 'link')
+        else:
+            head = root
+            hrefs = self._atom_entry_links(root)
+            alternate = None
+
+        # Relative links are resolved the way feedparser does it, against
+        # any xml:base in scope (and failing that, the feed URL)
+        entries = {_resolve_link(base or self.url, href.strip())
+                   for base, href in hrefs if href}
+
+        base, href = _text_href(alternate)
+        if href and href.strip():
+            feed_links.setdefault('alternate', set()).add(
+                urllib.parse.urljoin(base or self.url, href.strip()))
+
+        for link in head.iterfind(ATOM_NS + 'link'):
+            if link.get('href'):
+                feed_links.setdefault(sys.intern(link.get('rel', 'alternate')), set()).add(
+                    urllib.parse.urljoin(link.base or self.url, link.get('href')))
+
+        if head.find(HISTORY_NS + 'archive') is not None:
+            self.is_archive = True
+        elif head.find(HISTORY_NS + 'current') is not None:
+            self.is_archive = False
+
+        return entries, feed_links
+
+    @staticmethod
+    def _rss_entry_links(channel: lxml.etree._Element) -> typing.Iterator[_Href]:
+        """ Get the link and comments URL of every item in an RSS channel,
+        following feedparser's rules for which link that is """
+        for item in channel.iterfind('item'):
+            # Whichever of <link> or an Atom alternate link comes last wins
+            link: _Href = (None, None)
+            for node in item.iterchildren('link', ATOM_NS + 'link'):
+                if node.tag == 'link':
+                    if node.text:
+                        link = _text_href(node)
+                elif _is_alternate(node) and node.get('href'):
+                    link = (node.base, node.get('href'))
+
+            if not link[1]:
+                # feedparser treats the guid as the link unless told otherwise
+                guid = item.find('guid')
+                if guid is not None and guid.get('isPermaLink', 'true') == 'true':
+                    link = _text_href(guid)
+
+            yield link
+            yield _text_href(item.find('comments'))
+
+    @staticmethod
+    def _atom_entry_links(feed: lxml.etree._Element) -> typing.Iterator[_Href]:
+        """ Get the link of every entry in an Atom feed, following feedparser's
+        rules for which link that is """
+        for entry in feed.iterfind(ATOM_NS + 'entry'):
+            href: _Href = (None, None)
+            for link in entry.iterfind(ATOM_NS + 'link'):
+                if _is_alternate(link):
+                    href = (link.base, link.get('href'))
+            # feedparser treats the id as the link if there isn't one
+            yield href if href[1] else _text_href(entry.find(ATOM_NS + 'id'))
 
     def _consume_feed(self, feed) -> typing.Tuple[typing.Set[str],
                                                   typing.Dict[str, typing.Set[str]]]:
@@ -77,15 +259,11 @@ class Feed:
         rel-links for the feed """
         entries: typing.Set[str] = set()
         for attr in ('link', 'comments'):
-            entries |= {
-                urllib.parse.urldefrag(
-                    urllib.parse.urljoin(self.url, entry[attr])).url
-                for entry in feed['entries']
-                if entry and entry.get(attr)
-            }
-
-        feed_links: typing.DefaultDict[str,
-                                       typing.Set[str]] = collections.defaultdict(set)
+            entries.update(_resolve_link(self.url, entry[attr])
+                           for entry in feed['entries']
+                           if entry and entry.get(attr))
+
+        feed_links: typing.Dict[str, typing.Set[str]] = {}
         if 'feed' in feed and 'links' in feed.feed:
             for link in feed.feed.links:
                 # conveniently this also contains the rel links from HTML
@@ -94,27 +272,25 @@ class Feed:
                 rel = link.get('rel')
 
                 if rel and href:
-                    feed_links[rel].add(href)
+                    feed_links.setdefault(sys.intern(rel), set()).add(href)
 
         return entries, feed_links
 
     def _consume_mf2(self, items, entries: typing.Set[str]):
         """ Given a parsed mf2 feed, return the links to its entries """
-        for item in items:
-            if ('h-entry' in item.get('type', []) and
-                    'properties' in item and 'url' in item['properties']):
-                for url in item['properties']['url']:
-                    entries.add(urllib.parse.urljoin(self.url, url))
-            if 'children' in item:
-                self._consume_mf2(item['children'], entries)
+        stack = list(items)
+        while stack:
+            item = stack.pop()
+            props = item.get('properties')
+            if props and 'url' in props and 'h-entry' in item.get('type', ()):
+                entries.update(urllib.parse.urljoin(self.url, url)
+                               for url in props['url'])
+            stack.extend(item.get('children', ()))
 
     @property
     def canonical(self) -> str:
         """ Return the canonical URL for this feed """
-        for href in itertools.chain(self.links['canonical'], self.links['self']):
-            return href
-
-        return self.url
+        return self._canonical
 
 
 async def get_feed(config, url: str) -> typing.Tuple[typing.Optional[Feed],
@@ -152,7 +328,17 @@ async def get_feed(config, url: str) -> typing.Tuple[typing.Optional[Feed],
         LOGGER.debug("%s: Reusing cached version", url)
         return previous, previous, False
 
-    current = Feed(request)
+    etag = request.headers.get('etag')
+    if (previous and etag and not etag.startswith('W/')
+            and previous.caching.get('if-none-match') == etag):
+        # The server ignored our If-None-Match but sent back the same strong
+        # ETag, which means the content is byte-for-byte identical
+        LOGGER.debug("%s: ETag unchanged, reusing cached version", url)
+        return previous, previous, False
+
+    # Hashing and parsing a large feed can take a while, so keep it off the
+    # event loop; this also lets concurrently-fetched feeds hash in parallel
+    current = await utils.run_parse(config, Feed, request, previous)
 
     if config.cache:
         LOGGER.debug("%s: Saving to cache", url)
@@ -1,68 +1,143 @@
 """ Utility functions """
 
 import asyncio
+import codecs
+import functools
+import hashlib
 import logging
+import random
+import re
 import ssl
 import sys
+import threading
 import typing
 import urllib.parse
 
 import aiohttp
-from bs4 import BeautifulSoup
+import lxml.etree
+import lxml.html
 
 LOGGER = logging.getLogger('utils')
 
+# Copying an initialized hash state is cheaper than setting up a new one
+_DIGEST_SEED = hashlib.blake2b(digest_size=16)
 
-def decode_text(data: bytes, request: aiohttp.ClientResponse) -> str:
-    """ Try to guess the encoding of a request without going through the slow chardet process"""
+MAX_RETRIES = 5
+
+# Nothing we fetch has any business being larger than this; anything past it
+# is dropped rather than held in memory
+MAX_BODY_SIZE = 32 * 1024 * 1024
+
+# The charset parameter of a Content-Type header
+_CHARSET_RE = re.compile(r'charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+
+# A <meta charset> or <meta http-equiv="Content-Type"> declaration; like a
+# browser, we only look for one near the start of the document
+_META_CHARSET_RE = re.compile(rb'<meta[^>]*?charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+_META_CHARSET_SCAN = 2048
+
+
+# Charsets that browsers actually decode as windows-1252, per the WHATWG
+# Encoding Standard; real-world "Latin-1" content is full of smart quotes
+# and dashes from the 0x80-0x9F range that ISO-8859-1 leaves undefined
+_WINDOWS_1252_ALIASES = frozenset(('ascii', 'iso8859-1'))
+
+
+def _lookup_charset(url, charset: str) -> typing.Optional[str]:
+    """ Get the normalized name of a declared charset, if Python knows it """
+    try:
+        name = codecs.lookup(charset).name
+    except LookupError:
+        LOGGER.debug("%s: unknown charset %s", url, charset)
+        return None
+
+    # codecs also knows about transforms like hex, base64, and rot13, which
+    # bytes.decode and str.encode refuse to use
+    try:
+        b''.decode(name)
+        ''.encode(name)
+    except (LookupError, TypeError, UnicodeError):
+        LOGGER.debug("%s: %s is not a text encoding", url, charset)
+        return None
+
+    return 'cp1252' if name in _WINDOWS_1252_ALIASES else name
+
+
+def detect_encoding(data: bytes, request: aiohttp.ClientResponse) -> str:
+    """ Try to guess the encoding of a request without going through the slow
+    chardet process, or decoding anything """
     ctype = request.headers.get('content-type', '')
-    encoding = request.get_encoding()
+    encoding = None
 
     if not ctype:
         # we don't have a content-type, somehow, so...
         LOGGER.warning("%s: no content-type; headers are %s",
                        request.url, request.headers)
 
-    # try to derive it from the document
-    text = data.decode(encoding or 'utf-8', 'ignore')
-    if 'html' in ctype:
-        soup = BeautifulSoup(text, 'html.parser')
-        meta = soup.find('meta', charset=True)
-        if meta:
-            encoding = meta.attrs['charset']
-        else:
-            meta = soup.find('meta', {'http-equiv': True, 'content': True})
-            if meta and meta.attrs['http-equiv'].lower() == 'content-type':
-                ctype = meta.attrs['content']
+    header_match = _CHARSET_RE.search(ctype)
+    if header_match:
+        encoding = _lookup_charset(request.url, header_match.group(1))
 
-    # html default (or at least close enough)
-    if not encoding and ctype in ('text/html', 'text/plain'):
-        encoding = 'iso-8859-1'
+    if not encoding and data.isascii():
+        # There's no declared charset, and the utf-8 default decodes ASCII
+        # identically, so there's no point in looking for a <meta> one (7-bit
+        # stateful encodings like ISO-2022-JP would have to be declared)
+        return 'utf-8'
 
-    if not encoding or encoding == request.get_encoding():
-        # use the already-decoded version
-        return text
+    if not encoding and 'html' in ctype:
+        # The server didn't say, so try to derive it from the document
+        meta_match = _META_CHARSET_RE.search(data, 0, _META_CHARSET_SCAN)
+        if meta_match:
+            encoding = _lookup_charset(request.url, meta_match.group(1).decode('ascii'))
 
-    return data.decode(encoding, 'ignore')
+    return encoding or 'utf-8'
 
 
+@functools.lru_cache(maxsize=4096)
 def get_domain(url: str) -> str:
     """ Get the domain part of a URL """
     return urllib.parse.urlparse(url).netloc.lower()
 
 
+def digest(data: bytes) -> bytes:
+    """ Get the content digest used for change detection """
+    hasher = _DIGEST_SEED.copy()
+    hasher.update(data)
+    return hasher.digest()
+
+
+async def run_parse(config, func: typing.Callable, *args):
+    """ Run a CPU-bound parsing function on the parse pool """
+    return await asyncio.get_running_loop().run_in_executor(config.parse_pool, func, *args)
+
+
 class RequestResult:
     """ The results we need from a request """
 
     def __init__(self, request: aiohttp.ClientResponse, data: typing.Optional[bytes]):
         self.url = request.url
-        self.headers = request.headers.copy()
+        # the response's headers are already an immutable proxy, so there's
+        # no need to copy them
+        self.headers = request.headers
         self.status = request.status
         self.links = request.links
-        if data:
-            self.text = decode_text(data, request)
-        else:
-            self.text = ''
+        self.data = data or b''
+        self._response = request
+
+    @functools.cached_property
+    def encoding(self) -> str:
+        """ The encoding of the response body """
+        # Finding the encoding only looks at the headers and the first part
+        # of the body, so the parsers that work from the raw bytes never pay
+        # for decoding the whole thing
+        if not self.data:
+            return 'utf-8'
+        return detect_encoding(self.data, self._response)
+
+    @functools.cached_property
+    def text(self) -> str:
+        """ The decoded response body """
+        return self.data.decode(self.encoding, 'ignore')
 
     @property
     def success(self) -> bool:
@@ -80,16 +155,69 @@ class RequestResult:
         return self.status == 304
 
 
+# lxml parsers can't be shared between threads
+_THREAD_LOCAL = threading.local()
+
+
+def _get_parser(encoding: str) -> lxml.html.HTMLParser:
+    """ Get this thread's HTML parser for a particular encoding. The encoding
+    has already been determined from the response, so this keeps lxml from
+    second-guessing it from any in-document declarations. """
+    parsers = _THREAD_LOCAL.__dict__.setdefault('parsers', {})
+    if encoding not in parsers:
+        parsers[encoding] = lxml.html.HTMLParser(encoding=encoding)
+    return parsers[encoding]
+
+
+def parse_html(request: RequestResult) -> lxml.html.HtmlElement:
+    """ Parse the raw response body using the encoding it was decoded with """
+    try:
+        try:
+            return lxml.html.document_fromstring(request.data,
+                                                 parser=_get_parser(request.encoding))
+        except LookupError:
+            # lxml doesn't know this encoding, so let it have the decoded text
+            return lxml.html.document_fromstring(request.text.encode('utf-8'),
+                                                 parser=_get_parser('utf-8'))
+    except lxml.etree.ParserError:
+        # document is empty
+        return lxml.html.Element('html')
+
+
+def retry_delay(retries: int) -> float:
+    """ How long to wait before the next attempt. This backs off
+    exponentially, with some jitter so that the many requests that fail
+    against the same server at once don't all come back at the same time. """
+    return 0.5 * 2 ** retries * (1 + random.random() / 2)
+
+
+async def _read_body(request: aiohttp.ClientResponse) -> bytes:
+    """ Read a response body, up to MAX_BODY_SIZE """
+    chunks = []
+    size = 0
+    async for chunk in request.content.iter_chunked(65536):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > MAX_BODY_SIZE:
+            LOGGER.warning("%s: response is larger than %d bytes; truncating",
+                           request.url, MAX_BODY_SIZE)
+            break
+    return b''.join(chunks)[:MAX_BODY_SIZE]
+
+
 async def _retry_do(func: typing.Callable,
                     url: str, *args,
+                    want_body: typing.Optional[typing.Callable[..., bool]] = None,
                     **kwargs) -> typing.Optional[RequestResult]:
     errors = set()
-    for retries in range(5):
+    for retries in range(MAX_RETRIES):
+        if retries:
+            await asyncio.sleep(retry_delay(retries - 1))
         try:
             async with func(url, *args, **kwargs) as request:
-                if request.status == 304:
+                if request.status == 304 or (want_body and not want_body(request)):
                     return RequestResult(request, None)
-                return RequestResult(request, await request.read())
+                return RequestResult(request, await _read_body(request))
         except aiohttp.client_exceptions.ClientResponseError as err:
             LOGGER.warning("%s: got client response error: %s", url, str(err))
             return None
@@ -102,31 +230,19 @@ async def _retry_do(func: typing.Callable,
             LOGGER.debug("%s: got error %s %s (retry=%d)", url,
                          exc_type, exc_value, retries)
             errors.add(str(exc_value))
-            await asyncio.sleep(retries)
 
     LOGGER.warning("%s: Exceeded maximum retries; errors: %s", url, errors)
     return None
 
 
-def _make_headers(config, kwargs):
-    """ Replace the kwargs with one where the headers include our user-agent """
-
-    headers = kwargs.get('headers')
-    headers = headers.copy() if headers is not None else {}
-    headers['User-Agent'] = config.args.user_agent
-
-    kwargs = kwargs.copy()
-    kwargs['headers'] = headers
-    return kwargs
-
-
 async def retry_get(config, url, *args, **kwargs):
-    """ aiohttp wrapper for GET """
-    return await _retry_do(config.session.get, url, *args,
-                           **_make_headers(config, kwargs))
+    """ aiohttp wrapper for GET
+
+    If want_body is given, it's called with the response, and the body is
+    only downloaded if it returns True. """
+    return await _retry_do(config.session.get, url, *args, **kwargs)
 
 
 async def retry_post(config, url, *args, **kwargs):
     """ aiohttp wrapper for POST """
-    return await _retry_do(config.session.post, url, *args,
-                           **_make_headers(config, kwargs))
+    return await _retry_do(config.session.post, url, *args, **kwargs)
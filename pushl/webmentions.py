@@ -1,19 +1,71 @@
 """ Functions for sending webmentions """
 
 import asyncio
+import datetime
+import email.utils
 import logging
-import re
+import time
 import typing
 import urllib.parse
 from abc import ABC, abstractmethod
 
-import async_lru
-from bs4 import BeautifulSoup
+import lxml.etree
 
 from . import caching, utils
 
 LOGGER = logging.getLogger(__name__)
-SCHEMA_VERSION = 5
+SCHEMA_VERSION = 6
+
+# The longest we'll trust a target's Cache-Control max-age, in seconds
+MAX_TARGET_AGE = 86400
+
+# Content types that can have <link> or <a> elements
+MARKUP_TYPES = frozenset(('text/html',
+                          'application/xhtml+xml',
+                          'text/xml',
+                          'application/xml'))
+
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+# Every canonical or webmention link, in document order; rel is a
+# space-separated list, so it's matched by whole tokens
+REL_LINK_XPATH = lxml.etree.XPath(
+    "(//link | //a)[@href and (contains(concat(' ', normalize-space(@rel), ' '), ' webmention ')"
+    " or self::link and contains(concat(' ', normalize-space(@rel), ' '), ' canonical '))]")
+
+
+def _is_markup(request) -> bool:
+    """ Check whether a response is a document that could have links in it """
+    mime_type = request.headers.get('content-type', '').partition(';')[0].strip().lower()
+    return mime_type in MARKUP_TYPES or mime_type.endswith('+xml')
+
+
+def _normalize_url(url: str) -> str:
+    """ Get the key that a target URL is looked up under, so that links which
+    only differ by fragment or by the case of the scheme or host share one """
+    parts = urllib.parse.urlsplit(url)
+    # only the host is case-insensitive, not any userinfo in front of it
+    userinfo, at, hostport = parts.netloc.rpartition('@')
+    return urllib.parse.urlunsplit((parts.scheme.lower(),
+                                    userinfo + at + hostport.lower(),
+                                    parts.path or '/',
+                                    parts.query,
+                                    ''))
+
+
+def _get_expiry(request: utils.RequestResult) -> typing.Optional[float]:
+    """ Get the time until which a target response can be reused without
+    checking back with the server """
+    max_age = caching.get_max_age(request.headers)
+    if not max_age:
+        return None
+
+    # A response from a shared cache has already used up part of its lifetime
+    age = request.headers.get('age', '').strip()
+    if age.isascii() and age.isdigit():
+        max_age -= int(age)
+
+    return time.time() + min(max_age, MAX_TARGET_AGE) if max_age > 0 else None
 
 
 class Endpoint(ABC):
@@ -28,6 +80,30 @@ class Endpoint(ABC):
         """ Send the mention via this protocol """
 
 
+def _retry_after(config, request: utils.RequestResult, retries: int) -> float:
+    """ Get how long to wait before retrying a request, per its Retry-After
+    header (if any), limited to the configured maximum """
+    value = request.headers.get('retry-after')
+    delay = None
+    if value:
+        value = value.strip()
+        if value.isascii() and value.isdigit():
+            # delay-seconds is only ever a non-negative integer (RFC 9110)
+            delay = float(value)
+        else:
+            # It might be an HTTP-date instead of a number of seconds
+            try:
+                when = email.utils.parsedate_to_datetime(value)
+                delay = (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                LOGGER.debug("%s: unparseable Retry-After '%s'", request.url, value)
+
+    if delay is None:
+        delay = utils.retry_delay(retries)
+
+    return min(max(delay, 0.0), config.args.max_retry_after)
+
+
 class WebmentionEndpoint(Endpoint):
     """ Implementation of the webmention protocol """
     # pylint:disable=too-few-public-methods
@@ -35,26 +111,30 @@ class WebmentionEndpoint(Endpoint):
     async def send(self, config, source, destination):
         LOGGER.info("Sending Webmention %s -> %s [%s]",
                     source, destination, self.endpoint)
-        retries = 5
-        while retries > 0:
+        # Encode the form once up front, rather than have aiohttp build and
+        # encode a new FormData on every attempt
+        data = urllib.parse.urlencode({'source': source,
+                                       'target': destination,
+                                       }).encode('ascii')
+        for retries in range(utils.MAX_RETRIES):
 
-            data = {'source': source,
-                    'target': destination,
-                    }
             LOGGER.debug('POST %s %s', self.endpoint, data)
             request = await utils.retry_post(
                 config,
                 self.endpoint,
-                data=data
+                data=data,
+                headers=FORM_HEADERS
             )
 
-            if request and 'retry-after' in request.headers:
-                retries -= 1
-                LOGGER.info("%s: retrying %s after %s seconds",
-                            self.endpoint, destination, request.headers['retry-after'])
-                await asyncio.sleep(float(request.headers['retry-after']))
+            if request and ('retry-after' in request.headers
+                            or request.status in (429, 503)):
+                delay = _retry_after(config, request, retries)
+                LOGGER.info("%s: retrying %s after %.1f seconds",
+                            self.endpoint, destination, delay)
+                await asyncio.sleep(delay)
             else:
-                if request:
+                # don't decode the response body unless it's actually logged
+                if request and LOGGER.isEnabledFor(logging.INFO):
                     LOGGER.info("%s: mention of %s -> %s %s: %s",
                                 self.endpoint, source, destination,
                                 "succeeded" if request.success else "failed",
@@ -75,42 +155,55 @@ class Target:
         self.caching = caching.make_headers(request.headers)
         self.schema = SCHEMA_VERSION
 
+        self.expires = _get_expiry(request)
+
         if request.success and not request.cached:
-            self.endpoint = self._get_endpoint(request, request.text)
+            self.endpoint = self._get_endpoint(request)
         else:
             self.endpoint = None
 
-    def _get_endpoint(self, request: utils.RequestResult, text: str) -> typing.Optional[Endpoint]:
-        def join(url):
-            return urllib.parse.urljoin(str(request.url), str(url))
-
-        # only attempt to parse the page if it's HTML or XML
-        ctype = request.headers.get('content-type')
-        if ctype and ('html' in ctype or 'xml' in ctype):
-            soup = BeautifulSoup(text, 'html.parser')
-        else:
-            soup = None
+    def _get_endpoint(self, request: utils.RequestResult) -> typing.Optional[Endpoint]:
+        base = str(request.url)
 
-        # If there's a canonical URL for the page, use that
-        if soup:
-            for link in soup.find_all('link', rel='canonical', href=True):
-                self.canonical = join(link.attrs['href'])
-                LOGGER.debug('%s: got canonical URL %s',
-                             request.url, self.canonical)
+        def join(url) -> str:
+            url = str(url)
+            if url.startswith(('http://', 'https://')):
+                # Already absolute, so there's nothing to resolve
+                return url
+            return urllib.parse.urljoin(base, url)
 
         # Response headers always take priority over page links
+        endpoint: typing.Optional[Endpoint] = None
         for rel, link in request.links.items():
             if link.get('url') and 'webmention' in rel.split():
-                return WebmentionEndpoint(join(link.get('url')))
+                endpoint = WebmentionEndpoint(join(link.get('url')))
+                break
+
+        # only attempt to parse the page if it's HTML or XML, and only if it
+        # mentions anything we still need to look for (going by the raw bytes,
+        # so that the page never needs to be decoded)
+        if not _is_markup(request):
+            return endpoint
+        data = request.data
+        if b'canonical' not in data and (endpoint or b'webmention' not in data):
+            return endpoint
+
+        root = utils.parse_html(request)
+
+        for node in REL_LINK_XPATH(root):
+            rels = node.get('rel').split()
+
+            # If there's a canonical URL for the page, use that
+            if node.tag == 'link' and 'canonical' in rels:
+                self.canonical = join(node.get('href'))
+                LOGGER.debug('%s: got canonical URL %s',
+                             request.url, self.canonical)
 
-        # attempt to parse the document (if parseable)
-        if not soup:
-            return None
+            # The first endpoint link wins, unless the headers already had one
+            if not endpoint and 'webmention' in rels:
+                endpoint = WebmentionEndpoint(join(node.get('href')))
 
-        for link in soup.find_all(('link', 'a'), rel='webmention', href=True):
-            return WebmentionEndpoint(join(link.attrs['href']))
-
-        return None
+        return endpoint
 
     async def send(self, config, source: str, href: str):
         """ Send a mention from source to href via this target's endpoint """
@@ -128,35 +221,57 @@ class Target:
 
             # If the resolved URL is different than the (de-fragmented) HREF URL,
             # show a warning since that can affect the validity of webmentions
-            match = re.match('([^#]*)(#(.*))?', href)
-            if match and self.canonical != match.group(1):
+            base, _, fragment = href.partition('#')
+            if self.canonical != base:
                 LOGGER.warning("""\
 For the best compatibility, URL %s (referenced from %s) should be updated to %s\
 """,
                                href, source,
-                               self.canonical + ('#' + match.group(3)
-                                                 if match.group(3) else ''))
+                               self.canonical + ('#' + fragment if fragment else ''))
 
 
-@async_lru.alru_cache(maxsize=1000)
 async def get_target(config, url: str) -> typing.Tuple[typing.Optional[Target], int, bool]:
     """ Given a resolved URL, get the webmention endpoint """
 
+    # Entries tend to link to the same places, so every lookup of a URL
+    # during a run shares the first one, even if it's still in flight
+    key = _normalize_url(url)
+    if key not in config.targets:
+        config.targets[key] = asyncio.create_task(_get_target(config, url, key))
+    return await asyncio.shield(config.targets[key])
+
+
+async def _get_target(config, url: str, key: str) -> typing.Tuple[typing.Optional[Target],
+                                                                  int, bool]:
+    """ Look up a target, given its URL and its normalized cache key """
+
     previous = config.cache.get(
-        'target', url, schema_version=SCHEMA_VERSION) if config.cache else None
+        'target', key, schema_version=SCHEMA_VERSION) if config.cache else None
+
+    if previous and previous.expires and previous.expires > time.time():
+        # The server said we can reuse this without checking back
+        LOGGER.debug("%s: cached target is still fresh", url)
+        return previous, previous.status, True
 
     headers = previous.caching if previous else None
 
-    request = await utils.retry_get(config, url, headers=headers)
+    # The body of anything else (images, PDFs, etc.) would never be looked at
+    request = await utils.retry_get(config, url, headers=headers, want_body=_is_markup)
     if not request or not request.success:
         return previous, request.status if request else 0, False
 
     if request.cached:
+        if previous and config.cache:
+            # The 304 itself may have renewed how long the cached copy is good for
+            expires = _get_expiry(request)
+            if expires:
+                previous.expires = expires
+                config.cache.set('target', key, previous)
         return previous, previous.status if previous else 0, True
 
     current = Target(request)
 
     if config.cache:
-        config.cache.set('target', url, current)
+        config.cache.set('target', key, current)
 
     return current, request.status, False